@@ -3,20 +3,28 @@ from pants.build_graph.build_file_aliases import BuildFileAliases
 from pants.build_graph.target import Target
 from upstreamable.rules.cargo import rules as cargo_rules
 from upstreamable.rules.rust_thrift import rules as rust_thrift_rules
+from upstreamable.rules.stripped_sources import rules as stripped_sources_rules
 from upstreamable.targets.cargo_subproject import CargoSubproject
 from upstreamable.targets.rust_thrift_library import RustThriftLibrary
 from upstreamable.targets.scala_2_12 import Scala212Deps
 
 
+# NB: These are pure functions of the plugin's own code, so build them once at import time rather
+# than every time the plugin is loaded.
+_BUILD_FILE_ALIASES = BuildFileAliases(
+  targets={
+    CargoSubproject.alias(): CargoSubproject,
+    RustThriftLibrary.alias(): RustThriftLibrary,
+  },
+  context_aware_object_factories={'scala_2_12_deps': Scala212Deps},
+)
+
+_RULES = (*cargo_rules(), *rust_thrift_rules(), *stripped_sources_rules())
+
+
 def build_file_aliases():
-  return BuildFileAliases(
-    targets={
-      CargoSubproject.alias(): CargoSubproject,
-      RustThriftLibrary.alias(): RustThriftLibrary,
-    },
-    context_aware_object_factories={'scala_2_12_deps': Scala212Deps},
-  )
+  return _BUILD_FILE_ALIASES
 
 
 def rules():
-  return [*cargo_rules(), *rust_thrift_rules()]
+  return _RULES
@@ -1,14 +1,14 @@
 import dataclasses
+import functools
 import logging
 import os
-import re
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
-from typing import List, Tuple
+from typing import Tuple
 
 from pants.backend.python.rules.pex_from_target_closure import PythonResources, PythonResourceTarget
-from pants.build_graph.address import Address, BuildFileAddress
+from pants.build_graph.address import Address
 from pants.engine.addressable import BuildFileAddresses
 from pants.engine.console import Console
 from pants.engine.fs import (
@@ -24,43 +24,65 @@ from pants.engine.isolated_process import (
   ExecuteProcessResult,
   FallibleExecuteProcessResult,
 )
-from pants.engine.legacy.graph import HydratedTarget, HydratedTargets, TransitiveHydratedTargets
+from pants.engine.legacy.graph import HydratedTargets, TransitiveHydratedTargets
 from pants.engine.legacy.structs import CargoTargetAdaptor
 from pants.engine.objects import Collection
 from pants.engine.parser import SymbolTable
 from pants.engine.rules import RootRule, UnionRule, console_rule, subsystem_rule, rule
 from pants.engine.selectors import Get, MultiGet
 from pants.rules.core.core_test_model import Status, TestResult, TestTarget
-from pants.rules.core.strip_source_root import SourceRootStrippedSources
 from pants.subsystem.subsystem import Subsystem
-from pants.util.enums import match
 from upstreamable.rules.rust_thrift import ThriftTargetRequest, ThriftBuildResult, ThriftLanguage
+from upstreamable.rules.stripped_sources import MergedStrippedSources
+from upstreamable.rules.util import build_file_address_for
 from upstreamable.targets.cargo_subproject import CargoSubproject
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass(frozen=True)
 class RelPath:
-  path: Path
+  # NB: This isn't an engine type, so it doesn't need to be a frozen dataclass. Treat it as
+  # immutable all the same.
+  __slots__ = ('path', 'str_path')
+
+  def __init__(self, path: Path) -> None:
+    assert not path.is_absolute()
+    self.path = path
+    self.str_path = str(path)
+
+  def __eq__(self, other) -> bool:
+    return isinstance(other, RelPath) and self.path == other.path
 
-  def __post_init__(self):
-    assert not self.path.is_absolute()
+  def __hash__(self) -> int:
+    return hash(self.path)
+
+  def __repr__(self) -> str:
+    return f'RelPath(path={self.path!r})'
 
 
 class CargoCommands(Enum):
-  build = 'build'
-  test = 'test'
+  # NB: Each member's value is the argv for its cargo subcommand.
+  build = ('build',)
+  test = ('test',)
+
+  def create_cargo_command_argv(self, launcher_path: RelPath) -> Tuple[str, ...]:
+    return (launcher_path.str_path,) + self.value
 
-  def create_cargo_command_argv(self, launcher_path: RelPath) -> List[str]:
-    intermediate_args = match(self, {CargoCommands.build: ['build'], CargoCommands.test: ['test']})
-    return [str(launcher_path.path), *intermediate_args]
+
+@functools.lru_cache(maxsize=None)
+def _features_arg(features: Tuple[str, ...]) -> str:
+  # NB: The engine already caches process executions by the content of the request (the input
+  # digest is a content hash, not an mtime), so the argv should only depend on the *set* of
+  # features requested. Sorting them keeps reordering a BUILD file from invalidating the cache.
+  return ' '.join(['pants-injected', *sorted(set(features))])
 
 
 @dataclass(frozen=True)
 class Cargo:
+  __slots__ = ('launcher_path', 'release_mode', 'release_mode_subdir')
   launcher_path: RelPath
   release_mode: bool
+  release_mode_subdir: str
 
   class Factory(Subsystem):
     options_scope = 'cargo'
@@ -88,56 +110,65 @@ class Cargo:
 
     def build(self) -> 'Cargo.Factory':
       options = self.get_options()
+      release_mode = bool(options.release_mode)
+      release_mode_subdir = ('release' if release_mode else 'debug')
       return Cargo(
         launcher_path=RelPath(Path(options.launcher_path or 'cargo')),
-        release_mode=bool(options.release_mode),
+        release_mode=release_mode,
+        release_mode_subdir=release_mode_subdir,
       )
 
-  @property
-  def _release_mode_subdir(self) -> str:
-    return 'release' if self.release_mode else 'debug'
-
   def _get_expected_output_binary_file(self, cargo_target: CargoTargetAdaptor) -> str:
-    return os.path.join('target', self._release_mode_subdir, str(cargo_target.cargo_output))
+    return f'{self._output_dir}/{cargo_target.cargo_output}'
 
-  def _glob_generated_resources(self, cargo_target: CargoTargetAdaptor) -> List[str]:
-    return list(cargo_target.generated_resources.include)
+  def _glob_generated_resources(self, cargo_target: CargoTargetAdaptor) -> Tuple[str, ...]:
+    return tuple(cargo_target.generated_resources.include)
 
   @property
   def _output_dir(self) -> str:
-    return f'target/{self._release_mode_subdir}'
+    return f'target/{self.release_mode_subdir}'
 
   def _rewrite_subproject_output_file(self, output_file: str) -> str:
-    ret = re.sub(f'^({self._output_dir})', '', output_file)
-    return f'{self._output_dir}/deps/{ret}'
+    output_dir = self._output_dir
+    if output_file.startswith(output_dir):
+      output_file = output_file[len(output_dir):]
+    return f'{output_dir}/deps/{output_file}'
+
+  def get_output_files(
+    self,
+    cargo_target: CargoTargetAdaptor,
+    extra_cargo_output_file_paths: Tuple[str, ...],
+  ) -> Tuple[str, ...]:
+    return (
+      self._get_expected_output_binary_file(cargo_target),
+      *self._glob_generated_resources(cargo_target),
+      *(self._rewrite_subproject_output_file(str(f)) for f in extra_cargo_output_file_paths),
+    )
 
   def create_execute_process_request(
     self,
     cargo_target: CargoTargetAdaptor,
     source_root_stripped_sources: Digest,
     command: CargoCommands,
-    extra_cargo_output_file_paths: Tuple[str, ...],
+    output_files: Tuple[str, ...],
   ) -> ExecuteProcessRequest:
-    argv = command.create_cargo_command_argv(self.launcher_path)
-    argv.extend(['--features', ' '.join([
-      'pants-injected',
-      *cargo_target.features,
-    ])])
+    argv = command.create_cargo_command_argv(self.launcher_path) + (
+      '--features', _features_arg(tuple(cargo_target.features)),
+    )
     ret = ExecuteProcessRequest(
-      argv=tuple(argv),
+      argv=argv,
       input_files=source_root_stripped_sources,
       description=f'Execute cargo to build the request {cargo_target}!',
+      # FIXME: a way to explicitly say "this is a hacky non-remotable process execution", which
+      # automatically adds the PATH to the subprocess env! NB: The rules calling this are memoized
+      # too, so this doesn't pick up a new PATH on every run: it's only re-read when the target's
+      # inputs are invalidated and the request is rebuilt. That's still better than capturing it
+      # in the Cargo instance, which only changes along with the cargo options.
       env={
-        # FIXME: a way to explicitly say "this is a hacky non-remotable process execution", which
-        # automatically adds the PATH to the subprocess env!
         'PATH': os.environ['PATH'],
-        'MODE': self._release_mode_subdir,
+        'MODE': self.release_mode_subdir,
       },
-      output_files=(
-        self._get_expected_output_binary_file(cargo_target),
-        *self._glob_generated_resources(cargo_target),
-        *(self._rewrite_subproject_output_file(str(f)) for f in extra_cargo_output_file_paths),
-      ),
+      output_files=output_files,
     )
     logger.debug(f'creating process execution request for cargo: {ret}')
     return ret
@@ -154,42 +185,43 @@ class ManyCargoTargetAdaptors(Collection[CargoTargetAdaptor]):
 
 @rule
 def filter_cargo_buildable_targets(hts: HydratedTargets, cargo: Cargo) -> ManyCargoTargetAdaptors:
-  buildable_targets = [
-    cargo.prepare_buildable_target(ht)
-    for ht in hts
-    if ht.adaptor.type_alias == CargoSubproject.alias()
-  ]
-  return ManyCargoTargetAdaptors(tuple(buildable_targets))
+  return ManyCargoTargetAdaptors(
+    tuple(
+      cargo.prepare_buildable_target(ht)
+      for ht in hts
+      if ht.adaptor.type_alias == CargoSubproject.ALIAS
+    )
+  )
 
 
 @dataclass(frozen=True)
 class CargoTargetMergedSources:
   digest: Digest
-  cargo_output_file_paths: Tuple[str, ...]
+  # NB: This is computed here rather than per process request so that building and testing the
+  # same target share it.
+  output_files: Tuple[str, ...]
 
 
 @rule
 async def prepare_cargo_target_sources(
   cargo_target: CargoTargetAdaptor,
+  cargo: Cargo,
 ) -> CargoTargetMergedSources:
-  cur_target_bfa = BuildFileAddress(
-    build_file=None,
-    target_name=cargo_target.address.target_name,
-    rel_path=os.path.join(cargo_target.address.spec_path, 'BUILD'),
+  cur_target_bfa = build_file_address_for(
+    cargo_target.address.target_name,
+    cargo_target.address.spec_path,
   )
 
-  # Resources.
+  # Resources and thrift generation. Thrift only needs the cargo target itself, so it can run
+  # alongside stripping the closure.
   thts = await Get[TransitiveHydratedTargets](BuildFileAddresses((cur_target_bfa,)))
-  all_stripped_sources = await MultiGet(
-    Get[SourceRootStrippedSources](HydratedTarget, ht) for ht in thts.closure
+  stripped_closure, thrift_result = await MultiGet(
+    Get[MergedStrippedSources](HydratedTargets(tuple(thts.closure))),
+    Get[ThriftBuildResult](ThriftTargetRequest(
+      target=cargo_target,
+      language=ThriftLanguage.rust,
+    )),
   )
-  all_stripped_sources = [s.snapshot.directory_digest for s in all_stripped_sources]
-
-  # Thrift generation.
-  thrift_result = await Get[ThriftBuildResult](ThriftTargetRequest(
-    target=cargo_target,
-    language=ThriftLanguage.rust,
-  ))
 
   # Inject any subprojects.
   all_subproject_digests = [
@@ -204,18 +236,20 @@ async def prepare_cargo_target_sources(
 
   all_merged_sources = await Get[Digest](
     DirectoriesToMerge(
-      (*all_stripped_sources, thrift_result.snapshot.directory_digest, *all_subproject_digests),
+      (stripped_closure.digest, thrift_result.snapshot.directory_digest, *all_subproject_digests),
       strictness=MergeDirectoriesStrictness.allow_duplicates,
     )
   )
 
   return CargoTargetMergedSources(
     digest=all_merged_sources,
-    cargo_output_file_paths=tuple(all_subproject_output_files))
+    output_files=cargo.get_output_files(cargo_target, tuple(all_subproject_output_files)),
+  )
 
 
 @dataclass(frozen=True)
 class CargoBuildResult:
+  __slots__ = ('snapshot',)
   snapshot: Snapshot
 
 
@@ -229,7 +263,7 @@ async def execute_cargo(buildable_target: CargoTargetAdaptor, cargo: Cargo) -> C
       cargo_target=buildable_target,
       source_root_stripped_sources=all_merged_sources.digest,
       command=CargoCommands.build,
-      extra_cargo_output_file_paths=all_merged_sources.cargo_output_file_paths,
+      output_files=all_merged_sources.output_files,
     ),
   )
   snapshot = await Get[Snapshot](Digest, exe_res.output_directory_digest)
@@ -252,7 +286,7 @@ async def execute_cargo_test(testable_target: CargoTargetAdaptor, cargo: Cargo)
       cargo_target=testable_target,
       source_root_stripped_sources=all_merged_sources.digest,
       command=CargoCommands.test,
-      extra_cargo_output_file_paths=all_merged_sources.cargo_output_file_paths,
+      output_files=all_merged_sources.output_files,
     ),
   )
   return TestResult.from_fallible_execute_process_result(exe_res)
@@ -1,13 +1,20 @@
 import os
-import re
 from dataclasses import dataclass
 from enum import Enum
+from typing import Tuple
 
 from pants.backend.codegen.thrift.python.python_thrift_library import PythonThriftLibrary
 from pants.backend.python.rules.pex_from_target_closure import PythonResources, PythonResourceTarget
-from pants.build_graph.address import Address, BuildFileAddress
+from pants.build_graph.address import Address
 from pants.engine.addressable import BuildFileAddresses
-from pants.engine.fs import Digest, DirectoriesToMerge, DirectoryWithPrefixToStrip, Snapshot
+from pants.engine.fs import (
+  EMPTY_SNAPSHOT,
+  Digest,
+  DirectoriesToMerge,
+  DirectoryWithPrefixToStrip,
+  MergeDirectoriesStrictness,
+  Snapshot,
+)
 from pants.engine.isolated_process import ExecuteProcessRequest, ExecuteProcessResult
 from pants.engine.legacy.graph import HydratedTarget, HydratedTargets, TransitiveHydratedTargets
 from pants.engine.legacy.structs import CargoTargetAdaptor, TargetAdaptor, PythonThriftLibraryAdaptor
@@ -15,12 +22,14 @@ from pants.engine.objects import Collection
 from pants.engine.rules import RootRule, UnionRule, rule
 from pants.engine.selectors import Get, MultiGet
 from pants.rules.core.strip_source_root import SourceRootStrippedSources
-from pants.util.enums import match
+from upstreamable.rules.stripped_sources import MergedStrippedSources
+from upstreamable.rules.util import build_file_address_for
 from upstreamable.targets.rust_thrift_library import RustThriftLibrary
 
 
 @dataclass(frozen=True)
 class RustThriftLibraryWrapper:
+  __slots__ = ('underlying',)
   underlying: TargetAdaptor
 
 
@@ -34,13 +43,14 @@ def filter_rust_thrift_targets(hts: HydratedTargets) -> ManyRustThriftLibraryAda
     tuple(
       RustThriftLibraryWrapper(ht.adaptor)
       for ht in hts
-      if ht.adaptor.type_alias == RustThriftLibrary.alias()
+      if ht.adaptor.type_alias == RustThriftLibrary.ALIAS
     )
   )
 
 
 @dataclass(frozen=True)
 class PythonThriftLibraryWrapper:
+  __slots__ = ('underlying',)
   underlying: TargetAdaptor
 
 
@@ -50,11 +60,12 @@ class ManyPythonThriftLibraryAdaptors(Collection[PythonThriftLibraryWrapper]):
 
 @rule
 def filter_python_thrift_targets(hts: HydratedTargets) -> ManyPythonThriftLibraryAdaptors:
+  python_thrift_alias = PythonThriftLibrary.alias()
   return ManyPythonThriftLibraryAdaptors(
     tuple(
       PythonThriftLibraryWrapper(ht.adaptor)
       for ht in hts
-      if ht.adaptor.type_alias == PythonThriftLibrary.alias()
+      if ht.adaptor.type_alias == python_thrift_alias
     )
   )
 
@@ -69,54 +80,54 @@ class ThriftLanguage(Enum):
   python = 'python'
 
 
-@dataclass(frozen=True)
-class ThriftRequest:
-  target: TargetAdaptor
-  language: ThriftLanguage
+# NB: This lives at module scope because any plain class attribute of an Enum becomes a member.
+_THRIFT_GENERATOR_FOR_LANGUAGE = {
+  ThriftLanguage.rust: 'rs',
+  ThriftLanguage.python: 'py',
+}
+
+
+_THRIFT_SUFFIX = '.thrift'
 
 
 def _strip_thrift_file_ext(filename: str) -> str:
-  return re.sub(r'\.thrift$', '', filename)
+  if filename.endswith(_THRIFT_SUFFIX):
+    return filename[:-len(_THRIFT_SUFFIX)]
+  return filename
 
 
-@rule
-async def execute_thrift(
-  request: ThriftRequest
-) -> ThriftBuildResult:
-  buildable_target = request.target
-  thts = await Get[TransitiveHydratedTargets](
-    BuildFileAddresses((buildable_target.address,) + tuple(buildable_target.dependencies))
-  )
-  all_stripped_sources = await MultiGet(
-    Get[SourceRootStrippedSources](HydratedTarget, ht) for ht in thts.closure
-  )
-  merged_stripped_sources = await Get[Digest](
-    DirectoriesToMerge(tuple(s.snapshot.directory_digest for s in all_stripped_sources))
-  )
+# NB: The engine memoizes rules by their params, so identical requests for the same file in the
+# same input chroot are only ever executed once.
+@dataclass(frozen=True)
+class ThriftFileRequest:
+  __slots__ = ('input_digest', 'thrift_file', 'language')
+  input_digest: Digest
+  thrift_file: str
+  language: ThriftLanguage
 
-  all_input_file_paths = (await Get[Snapshot](Digest, merged_stripped_sources)).files
-  cur_target_sources = [f for f in all_input_file_paths if f.endswith('.thrift')]
 
+@rule
+async def execute_thrift_file(request: ThriftFileRequest) -> ThriftBuildResult:
   # Get the expected output files or directories, depending on language.
   if request.language == ThriftLanguage.rust:
-    outputs = dict(output_files=tuple(f'{_strip_thrift_file_ext(f)}.rs'
-                                      for f in cur_target_sources))
+    outputs = dict(output_files=(f'{_strip_thrift_file_ext(request.thrift_file)}.rs',))
   else:
     assert request.language == ThriftLanguage.python
     outputs = dict(output_directories=('gen-py',))
 
-  # Execute thrift.
+  # Execute thrift. The thrift compiler only accepts a single input file per invocation.
   exe_res = await Get[ExecuteProcessResult](
     ExecuteProcessRequest(
       argv=('thrift',
-            '--gen', match(request.language, {
-              ThriftLanguage.rust: 'rs',
-              ThriftLanguage.python: 'py',
-            }),
+            '--gen', _THRIFT_GENERATOR_FOR_LANGUAGE[request.language],
             '-o', '.',
-            *cur_target_sources),
-      input_files=merged_stripped_sources,
-      description=f'invoke thrift {request.language} for target {buildable_target.address}!',
+            request.thrift_file),
+      input_files=request.input_digest,
+      description=f'invoke thrift {request.language} for file {request.thrift_file}!',
+      # FIXME: Like cargo, this is a hacky non-remotable process execution which needs the local
+      # PATH to find the thrift binary! NB: This rule is memoized, so the PATH is only re-read
+      # when this file's inputs are invalidated, rather than being fixed at import time for the
+      # life of a pantsd.
       env={'PATH': os.environ['PATH']},
       **outputs,
     )
@@ -125,8 +136,55 @@ async def execute_thrift(
   return ThriftBuildResult(snapshot)
 
 
+def _merge_thrift_snapshots(
+  merged_digest: Digest,
+  results: Tuple[ThriftBuildResult, ...],
+) -> Snapshot:
+  # NB: The individual snapshots already list their files, so there's no need to snapshot the merged
+  # digest again just to read them back out.
+  return Snapshot(
+    merged_digest,
+    files=tuple(sorted({f for r in results for f in r.snapshot.files})),
+    dirs=tuple(sorted({d for r in results for d in r.snapshot.dirs})),
+  )
+
+
+@dataclass(frozen=True)
+class ThriftRequest:
+  __slots__ = ('target', 'language', 'input_digest')
+  target: HydratedTarget
+  language: ThriftLanguage
+  # The stripped and merged sources of every thrift library being generated alongside this one.
+  input_digest: Digest
+
+
+@rule
+async def execute_thrift(request: ThriftRequest) -> ThriftBuildResult:
+  # Only generate code for this library's own sources. Its dependencies get their own request.
+  cur_target_stripped = await Get[SourceRootStrippedSources](HydratedTarget, request.target)
+  cur_target_sources = sorted(
+    f for f in cur_target_stripped.snapshot.files if f.endswith(_THRIFT_SUFFIX)
+  )
+
+  results = await MultiGet(
+    Get[ThriftBuildResult](ThriftFileRequest(
+      input_digest=request.input_digest,
+      thrift_file=f,
+      language=request.language,
+    )) for f in cur_target_sources
+  )
+  merged_digest = await Get[Digest](
+    DirectoriesToMerge(
+      tuple(r.snapshot.directory_digest for r in results),
+      strictness=MergeDirectoriesStrictness.allow_duplicates,
+    )
+  )
+  return ThriftBuildResult(_merge_thrift_snapshots(merged_digest, results))
+
+
 @dataclass(frozen=True)
 class ThriftTargetRequest:
+  __slots__ = ('target', 'language')
   target: TargetAdaptor
   language: ThriftLanguage
 
@@ -135,12 +193,10 @@ class ThriftTargetRequest:
 async def get_thrift_for_subproject(request: ThriftTargetRequest) -> ThriftBuildResult:
   thriftable_target = request.target
 
-  # Get all dependencies that are also thrift library targets to put them in the same chroot when
-  # executing thrift.
-  cur_target_bfa = BuildFileAddress(
-    build_file=None,
-    target_name=thriftable_target.address.target_name,
-    rel_path=os.path.join(thriftable_target.address.spec_path, 'BUILD'),
+  # Get all dependencies that are also thrift library targets, to generate each of them.
+  cur_target_bfa = build_file_address_for(
+    thriftable_target.address.target_name,
+    thriftable_target.address.spec_path,
   )
   thts = await Get[TransitiveHydratedTargets](BuildFileAddresses((cur_target_bfa,)))
 
@@ -154,19 +210,35 @@ async def get_thrift_for_subproject(request: ThriftTargetRequest) -> ThriftBuild
       HydratedTargets(tuple(thts.closure))
     )
 
+  if not thrift_targets:
+    return ThriftBuildResult(EMPTY_SNAPSHOT)
+
+  # Strip and merge the union of the thrift libraries' closures once, and share it as the chroot
+  # for every library, so any includes resolve. Asking for each library's closure separately would
+  # strip and merge the sources they have in common over and over.
+  thrift_thts = await Get[TransitiveHydratedTargets](BuildFileAddresses(tuple(
+    build_file_address_for(t.underlying.address.target_name, t.underlying.address.spec_path)
+    for t in thrift_targets
+  )))
+  stripped_thrift_closure = await Get[MergedStrippedSources](
+    HydratedTargets(tuple(thrift_thts.closure))
+  )
+
+  thrift_specs = {t.underlying.address.spec for t in thrift_targets}
   results = await MultiGet(
     Get[ThriftBuildResult](ThriftRequest(
-      target=t.underlying,
+      target=ht,
       language=request.language,
-    )) for t in thrift_targets
+      input_digest=stripped_thrift_closure.digest,
+    )) for ht in thts.closure if ht.address.spec in thrift_specs
   )
   merged_digest = await Get[Digest](
-    DirectoriesToMerge(tuple(r.snapshot.directory_digest for r in results))
+    DirectoriesToMerge(
+      tuple(r.snapshot.directory_digest for r in results),
+      strictness=MergeDirectoriesStrictness.allow_duplicates,
+    )
   )
-
-  merged_files = [f for r in results for f in r.snapshot.files]
-
-  return ThriftBuildResult(Snapshot(merged_digest, files=tuple(merged_files), dirs=()))
+  return ThriftBuildResult(_merge_thrift_snapshots(merged_digest, results))
 
 
 @rule
@@ -186,9 +258,11 @@ def rules():
   return [
     filter_rust_thrift_targets,
     filter_python_thrift_targets,
+    RootRule(ThriftFileRequest),
+    execute_thrift_file,
     RootRule(ThriftRequest),
-    RootRule(ThriftTargetRequest),
     execute_thrift,
+    RootRule(ThriftTargetRequest),
     get_thrift_for_subproject,
     UnionRule(PythonResourceTarget, PythonThriftLibraryAdaptor),
     RootRule(PythonThriftLibraryAdaptor),
@@ -0,0 +1,33 @@
+from dataclasses import dataclass
+
+from pants.engine.fs import Digest, DirectoriesToMerge, MergeDirectoriesStrictness
+from pants.engine.legacy.graph import HydratedTarget, HydratedTargets
+from pants.engine.rules import rule
+from pants.engine.selectors import Get, MultiGet
+from pants.rules.core.strip_source_root import SourceRootStrippedSources
+
+
+@dataclass(frozen=True)
+class MergedStrippedSources:
+  digest: Digest
+
+
+@rule
+async def merge_stripped_closure(hts: HydratedTargets) -> MergedStrippedSources:
+  """Strip the source roots from every target in `hts` and merge them into a single digest."""
+  all_stripped_sources = await MultiGet(
+    Get[SourceRootStrippedSources](HydratedTarget, ht) for ht in hts
+  )
+  merged = await Get[Digest](
+    DirectoriesToMerge(
+      tuple(s.snapshot.directory_digest for s in all_stripped_sources),
+      strictness=MergeDirectoriesStrictness.allow_duplicates,
+    )
+  )
+  return MergedStrippedSources(digest=merged)
+
+
+def rules():
+  return [
+    merge_stripped_closure,
+  ]
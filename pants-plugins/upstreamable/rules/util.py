@@ -0,0 +1,14 @@
+import functools
+import posixpath
+
+from pants.build_graph.address import BuildFileAddress
+
+
+@functools.lru_cache(maxsize=None)
+def build_file_address_for(target_name: str, spec_path: str) -> BuildFileAddress:
+  """Make a BuildFileAddress for a target whose BUILD file hasn't been parsed by the caller."""
+  return BuildFileAddress(
+    build_file=None,
+    target_name=target_name,
+    rel_path=posixpath.join(spec_path, 'BUILD'),
+  )
@@ -9,9 +9,11 @@ from pants.build_graph.target import Target
 class CargoSubproject(Target):
   """???/target representing a cargo subproject"""
 
+  ALIAS = 'cargo_subproject'
+
   # TODO: make this work in engine_initializer.py!
   default_sources_globs = ('**/*.rs', '**/*.toml')
 
   @classmethod
   def alias(cls) -> str:
-    return 'cargo_subproject'
+    return cls.ALIAS
@@ -9,9 +9,11 @@ from pants.build_graph.target import Target
 class RustThriftLibrary(Target):
   """???/target to be converted into rust thrift sources"""
 
+  ALIAS = 'rust_thrift_library'
+
   # TODO: make this work in engine_initializer.py!
-  default_sources_globs = '**/*.thrift'
+  default_sources_globs = ('**/*.thrift',)
 
   @classmethod
   def alias(cls) -> str:
-    return 'rust_thrift_library'
+    return cls.ALIAS
@@ -1,8 +1,8 @@
 import asyncio
+import functools
 import logging
-import sys
-import threading
-from contextlib import contextmanager
+import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from types import ModuleType
@@ -38,12 +38,27 @@ def get_resource_string(module: ModuleType, rel_path: Path) -> bytes:
 
 
 def open_dylib_resource(ffi: FFI, dylib: bytes):
+  # On Linux, dlopen() an anonymous in-memory file so the dylib never has to touch the disk.
+  if hasattr(os, 'memfd_create'):
+    try:
+      fd = os.memfd_create('libterminal_wrapper', os.MFD_CLOEXEC)
+      with os.fdopen(fd, 'wb') as f:
+        f.write(dylib)
+        f.flush()
+        return ffi.dlopen(f'/proc/self/fd/{fd}')
+    except OSError as e:
+      # The kernel or sandbox may not support memfd_create(), or /proc may not be mounted.
+      logger.debug('failed to load the dylib from a memfd, falling back to a temp file: %s', e)
+
   with temporary_file() as f:
     f.write(dylib)
     f.flush()
     return ffi.dlopen(f.name)
 
 
+# NB: Parsing the headers and extracting + dlopen()ing the dylib are only ever needed once per
+# process, so reuse the same FFI and library for every caller.
+@functools.lru_cache(maxsize=None)
 def bootstrap_thrift_ffi() -> FFI:
   ffi = FFI()
 
@@ -178,8 +193,16 @@ class FFIMulticastTransport(TTransportBase):
     self._is_open = False
 
     self._mutable_read_chunk = None
-    self._intermediary_write_chunk = None
-    self._max_cap = max(self._read_capacity, self._write_capacity)
+    # NB: The ThriftChunk only holds a raw pointer, so the cdata which owns the read buffer has to
+    # be kept alive here for as long as the chunk points at it.
+    self._read_chunk_backing_buf = None
+    # NB: Unlike the read chunk, this one only ever points at a caller-provided buffer for the
+    # duration of a single readinto().
+    self._readinto_chunk = None
+    # NB: The thrift protocol layer writes each message a field at a time, then calls flush() at
+    # the end of the message. Coalesce those writes here so each message crosses the FFI boundary
+    # once, instead of once per field.
+    self._pending_writes = bytearray()
 
     self._cur_read_result = None
     self._cur_write_result = None
@@ -187,25 +210,17 @@ class FFIMulticastTransport(TTransportBase):
   def isOpen(self):
     return self._is_open
 
-  def _zero_out_mutable_read_chunk(self):
+  def _allocate_read_chunk(self, capacity):
     assert self._mutable_read_chunk is not None
-    self._mutable_read_chunk[0] = dict(
-      ptr=self._ffi.NULL,
-      len=0,
-      capacity=0,
-    )
 
-  @contextmanager
-  def _with_chunk_from_buf(self, buf):
-    with self._ffi.from_buffer(buf) as data:
-      self._write_chunk[0] = dict(
-        ptr=data,
-        len=len(buf),
-        capacity=len(buf),
-      )
-      print(f'buf: {buf} / data: {data}', file=sys.stderr)
-      print(f'write_chunk: {self._write_chunk.ptr}', file=sys.stderr)
-      yield self._write_chunk
+    if self._read_chunk_backing_buf is not None:
+      self._ffi.release(self._read_chunk_backing_buf)
+    self._read_chunk_backing_buf = self._ffi.new('char[]', capacity)
+
+    chunk = self._mutable_read_chunk
+    chunk.ptr = self._read_chunk_backing_buf
+    chunk.len = 0
+    chunk.capacity = capacity
 
   def open(self):
     assert not self._is_open
@@ -216,19 +231,21 @@ class FFIMulticastTransport(TTransportBase):
 
     with self._ffi.new('UserClientRequest*') as request,\
          self._ffi.new('InternedObjectCreationResult*') as result:
-      request[0] = dict(
-        read_capacity=self._read_capacity,
-        write_capacity=self._write_capacity,
-        user_key=self._user,
-        topic_key=self._topic,
-        target_kind_key=self._target_user_kind,
-      )
+      request.read_capacity = self._read_capacity
+      request.write_capacity = self._write_capacity
+      request.user_key = self._user
+      request.topic_key = self._topic
+      request.target_kind_key = self._target_user_kind
       self._lib.create_user_client(request, result)
       assert result.tag == self._lib.Created
       self._handle[0] = result.created.tup_0
 
+    # NB: Only reads need a buffer of our own: writes borrow the caller's bytes. So size this from
+    # the read capacity alone, up front, rather than on the first read.
     self._mutable_read_chunk = self._ffi.new('ThriftChunk*')
-    self._zero_out_mutable_read_chunk()
+    self._allocate_read_chunk(self._read_capacity)
+
+    self._readinto_chunk = self._ffi.new('ThriftChunk*')
 
     self._cur_read_result = self._ffi.new('ThriftReadResult*')
     self._cur_write_result = self._ffi.new('ThriftWriteResult*')
@@ -238,16 +255,20 @@ class FFIMulticastTransport(TTransportBase):
   def close(self):
     assert self._is_open
 
-    # FIXME: Figure out why cffi says this can't be released!!
-    if self._mutable_read_chunk.ptr != self._ffi.NULL:
-      try:
-        self._ffi.release(self._mutable_read_chunk.ptr)
-      except ValueError:
-        pass
+    # Send anything written since the last flush() before the write chunk and handle go away, and
+    # don't let it leak into the next open().
+    self.flush()
+
+    if self._read_chunk_backing_buf is not None:
+      self._ffi.release(self._read_chunk_backing_buf)
+      self._read_chunk_backing_buf = None
 
     self._ffi.release(self._mutable_read_chunk)
     self._mutable_read_chunk = None
 
+    self._ffi.release(self._readinto_chunk)
+    self._readinto_chunk = None
+
     self._ffi.release(self._cur_read_result)
     self._cur_read_result = None
 
@@ -269,59 +290,108 @@ class FFIMulticastTransport(TTransportBase):
     if sz <= self._mutable_read_chunk.capacity:
       return
 
-    self._max_cap = sz
-
-    # FIXME: Figure out why cffi says this can't be released!!
-    if self._mutable_read_chunk.ptr != self._ffi.NULL:
-      try:
-        self._ffi.release(self._mutable_read_chunk.ptr)
-      except ValueError:
-        pass
-
-    self._mutable_read_chunk[0] = dict(
-      ptr=self._ffi.new('char[]', self._max_cap),
-      len=0,
-      capacity=self._max_cap,
-    )
+    # Grow geometrically, so a run of increasingly large reads only reallocates O(log n) times.
+    self._allocate_read_chunk(max(sz, self._mutable_read_chunk.capacity * 2))
 
   def read(self, sz):
     assert self._is_open
 
     self._maybe_expand_chunk(sz)
 
-    self._mutable_read_chunk.len = sz
-
+    # NB: This is called at least once per thrift field, so look up everything it touches once.
+    lib = self._lib
+    chunk = self._mutable_read_chunk
     result = self._cur_read_result
-    print(f'({self._user.tup_0}) begin read of size {sz}', file=sys.stderr)
-    self._lib.receive_topic_messages(self._handle[0], self._mutable_read_chunk[0], result)
-    print(f'({self._user.tup_0}) end read of size {sz}', file=sys.stderr)
-    assert result.tag == self._lib.Read
+
+    chunk.len = sz
+
+    logger.debug('(%s) begin read of size %d', self._user.tup_0, sz)
+    lib.receive_topic_messages(self._handle[0], chunk[0], result)
+    logger.debug('(%s) end read of size %d', self._user.tup_0, sz)
+    assert result.tag == lib.Read
     read = result.read.tup_0
     assert read <= sz
 
-    buf = self._ffi.buffer(self._mutable_read_chunk.ptr, read)[:]
-    print(f'read={read}, buf={buf}')
+    buf = self._ffi.buffer(chunk.ptr, read)[:]
+    logger.debug('read=%d, buf=%s', read, buf)
 
     return buf
 
-  def write(self, buf):
+  def readinto(self, buf):
+    """Receive directly into the writable buffer `buf`, returning the number of bytes read.
+
+    This skips the copy out of the transport's own read buffer that read() has to make.
+    """
     assert self._is_open
 
-    with self._with_chunk_from_buf(buf) as chunk:
-      result = self._cur_write_result
-      print(f'({self._user.tup_0}) begin write of size {len(buf)}', file=sys.stderr)
-      self._lib.send_topic_messages(self._handle[0], chunk[0], result)
-      print(f'({self._user.tup_0}) end write of size {len(buf)}', file=sys.stderr)
-      assert result.tag == self._lib.Written
+    ffi = self._ffi
+    lib = self._lib
+    chunk = self._readinto_chunk
+    result = self._cur_read_result
 
-    return result.written
+    buf_len = len(buf)
+    with ffi.from_buffer(buf, require_writable=True) as data:
+      chunk.ptr = data
+      chunk.len = buf_len
+      chunk.capacity = buf_len
+      logger.debug('(%s) begin readinto of size %d', self._user.tup_0, buf_len)
+      lib.receive_topic_messages(self._handle[0], chunk[0], result)
+      logger.debug('(%s) end readinto of size %d', self._user.tup_0, buf_len)
+      # Don't leave a dangling pointer to the caller's buffer around.
+      chunk.ptr = ffi.NULL
+    assert result.tag == lib.Read
+    read = result.read.tup_0
+    assert read <= buf_len
+    return read
+
+  def readAll(self, sz):
+    # NB: TTransportBase.readAll() appends each chunk to a bytes object, which copies everything
+    # read so far on every iteration. Receive straight into a single preallocated buffer instead.
+    out = bytearray(sz)
+    view = memoryview(out)
+    have = 0
+    while have < sz:
+      read = self.readinto(view[have:])
+      if read == 0:
+        raise EOFError()
+      have += read
+    return bytes(out)
+
+  def write(self, buf):
+    assert self._is_open
+    self._pending_writes += buf
 
   def flush(self):
     assert self._is_open
-    # An in-memory buffer has no flush step -- see the docs for the rust TBufferChannel (which this
-    # uses) flush() at
+
+    buf = self._pending_writes
+    buf_len = len(buf)
+    if buf_len == 0:
+      return
+
+    lib = self._lib
+    chunk = self._write_chunk
+    result = self._cur_write_result
+
+    # NB: The cffi buffer's own context manager is kept (rather than a generator-based helper)
+    # because the export has to be released before `buf` can be resized below.
+    with self._ffi.from_buffer(buf) as data:
+      # NB: Set each field directly, which avoids cffi converting a dict to the struct on every
+      # flush.
+      chunk.ptr = data
+      chunk.len = buf_len
+      chunk.capacity = buf_len
+      logger.debug('buf: %s / data: %s', buf, data)
+
+      logger.debug('(%s) begin write of size %d', self._user.tup_0, buf_len)
+      lib.send_topic_messages(self._handle[0], chunk[0], result)
+      logger.debug('(%s) end write of size %d', self._user.tup_0, buf_len)
+      assert result.tag == lib.Written
+
+    # NB: This can only be resized once the buffer exported to cffi above has been released. The
+    # rust TBufferChannel has no flush step of its own -- see
     # https://github.com/apache/thrift/blob/master/lib/rs/src/transport/mem.rs#L183-L185!
-    pass
+    del buf[:]
 
 
 # async def event_loop() -> AsyncGenerator[TerminalEvent]:
@@ -354,9 +424,7 @@ def main() -> None:
   client_user = ffi.new('InternKey*')
   with ffi.new('UserRequest*') as request,\
        ffi.new('InternedObjectCreationResult*') as result:
-    request[0] = dict(
-      kind=client_user_kind[0],
-    )
+    request.kind = client_user_kind[0]
     lib.create_user(request, result)
     assert result.tag == lib.Created
     client_user[0] = result.created.tup_0
@@ -364,9 +432,7 @@ def main() -> None:
   server_user = ffi.new('InternKey*')
   with ffi.new('UserRequest*') as request,\
        ffi.new('InternedObjectCreationResult*') as result:
-    request[0] = dict(
-      kind=server_user_kind[0],
-    )
+    request.kind = server_user_kind[0]
     lib.create_user(request, result)
     assert result.tag == lib.Created
     server_user[0] = result.created.tup_0
@@ -408,23 +474,27 @@ def main() -> None:
   client_protocol = TBinaryProtocolAccelerated(client_transport)
   client = TerminalWrapper.Client(client_protocol)
 
-  def server_fun():
-    server.serve()
-
-  server_thread = threading.Thread(target=server_fun)
-  server_thread.start()
+  # NB: The client calls stay serial: they share a single transport, and a thrift client isn't safe
+  # to call concurrently.
+  server_executor = ThreadPoolExecutor(max_workers=1)
+  try:
+    server_future = server_executor.submit(server.serve)
 
-  ret = client.beginExecution(ProcessExecutionRequest())
-  assert ret == RunId('asdf')
-  print(f'ret = {ret}')
+    ret = client.beginExecution(ProcessExecutionRequest())
+    assert ret == RunId('asdf')
+    print(f'ret = {ret}')
 
-  ret = client.getNextEvent()
-  assert ret.run_id == RunId('asdf')
-  print(f'ret = {ret}')
+    ret = client.getNextEvent()
+    assert ret.run_id == RunId('asdf')
+    print(f'ret = {ret}')
 
-  client_transport.close()
+    client_transport.close()
 
-  server_thread.join()
+    server_future.result()
+  finally:
+    # NB: serve() doesn't return while its transport is alive, so waiting on the worker here (as
+    # leaving a `with` block would) hangs instead of raising an error from the client calls above.
+    server_executor.shutdown(wait=False)
 
   with ffi.new('InternedObjectDestructionResult*') as result:
     lib.destroy_topic(topic[0], result)